@@ -1,9 +1,21 @@
-import os, time, requests, logging
+import os, sys, time, random, json, queue, requests, logging
+from logging.handlers import QueueHandler, QueueListener
 from dotenv import load_dotenv
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util import Retry, make_headers
 import RPi.GPIO as GPIO
 import atexit
+from functools import lru_cache
+# orjson is opt-in (not in requirements.txt / environment.yml): `pip install orjson` on the Pi
+# for a faster C parser; without it the stdlib parser is used on the raw response bytes
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 
 def cleanup_gpio():
@@ -30,15 +42,45 @@ for pin in LED_PINS.values():
 
 # --- config ---
 BERLIN = ZoneInfo("Europe/Berlin")
-POLL_INTERVAL_SEC = 1.1
-STALE_AFTER = timedelta(minutes=2)  # treat data older than this as failure
+POLL_INTERVAL_SEC = 1.1              # fast poll while the next row is due but not there yet
+ROW_INTERVAL = timedelta(minutes=1)  # API publishes one row per minute
+STALE_AFTER = timedelta(minutes=2)   # treat data older than this as failure
+FETCH_WINDOW = STALE_AFTER + ROW_INTERVAL  # just wide enough that a stale row still shows up as stale
+TOKEN_URL = "https://identity.netztransparenz.de/users/connect/token"
+BASE_URL = "https://ds.netztransparenz.de/api/v1/data/TrafficLight/"
+AUTH_TEMPLATE = "Bearer {}"
+TOKEN_CACHE = os.path.expanduser("~/.cache/tl/token.json")  # survives reboots -> no auth round-trip at startup
+
+# --- credentials (read once; .env is only parsed when they aren't already in the environment) ---
+if not os.getenv("IPNT_CLIENT_ID"):
+    load_dotenv()
+CLIENT_ID     = os.environ["IPNT_CLIENT_ID"]      # KeyError here = fail fast instead of sending None
+CLIENT_SECRET = os.environ["IPNT_CLIENT_SECRET"]
+
+# --- http session (pooled keep-alive connections, reused across polls) ---
+SESSION = requests.Session()
+# advertise every encoding urllib3 can decode here (gzip/deflate, plus br when brotli is installed)
+SESSION.headers.update({"Connection": "keep-alive", **make_headers(accept_encoding=True)})
+# transient 5xx are retried by urllib3 on the pooled connection instead of failing the whole poll;
+# Retry-After is ignored so a long server-requested wait can't stall the LED loop (stale/failure handling takes over)
+RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504], allowed_methods=["GET", "POST"],
+              respect_retry_after_header=False)
+for host in ("https://identity.netztransparenz.de", "https://ds.netztransparenz.de"):
+    SESSION.mount(host, HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=RETRY))
 
 # --- logging ---
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s | %(message)s",
-)
-
+# The loop only enqueues records; a background thread does the (possibly slow, e.g. serial console) writes
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s | %(message)s"))
+log_listener = QueueListener(log_queue, log_handler, respect_handler_level=True)
+logging.root.setLevel(logging.INFO)
+logging.root.addHandler(QueueHandler(log_queue))  # no formatter here: the listener's handler formats
+log_listener.start()
+atexit.register(log_listener.stop)  # flush pending records on exit
+log = logging.getLogger(__name__)
+
+@lru_cache(maxsize=64)  # consecutive polls keep returning the same timestamps
 def iso_utc(ts: str) -> datetime:
     # Normalize common API variants to an aware UTC datetime
     # Examples seen: "2025-09-08T13:23:00Z", "2025-09-08T13:23:00+00:00", "2025-09-08T13:23:00"
@@ -49,6 +91,17 @@ def iso_utc(ts: str) -> datetime:
         dt = dt.replace(tzinfo=timezone.utc)  # assume UTC if missing
     return dt.astimezone(timezone.utc)
 
+# plain f-strings instead of strftime (no libc locale round-trip on every call)
+def fmt_api(dt: datetime) -> str:
+    # "2025-09-08T13:23:00Z" as used in the API URL (dt must already be UTC)
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z"
+
+def fmt_local(dt: datetime) -> str:
+    # Berlin wall-clock string for log output (only needed when a row is logged)
+    loc = dt.astimezone(BERLIN)
+    tzname = "CEST" if loc.utcoffset() == timedelta(hours=2) else "CET"
+    return f"{loc.year:04d}-{loc.month:02d}-{loc.day:02d} {loc.hour:02d}:{loc.minute:02d}:{loc.second:02d} {tzname}"
+
 # --- hardware stubs (replace later) ---
 def led_ok(color: str):
     # Turn off all LEDs first
@@ -114,33 +167,100 @@ VALUE_MAP = {
     "RED_POS": 3,   "RED_NEG": -3,
 }
 
-def get_token(client_id: str, client_secret: str) -> str:
-    resp = requests.post(
-        "https://identity.netztransparenz.de/users/connect/token",
+def get_token(client_id: str, client_secret: str) -> tuple[str, datetime]:
+    resp = SESSION.post(
+        TOKEN_URL,
         data={"grant_type": "client_credentials",
               "client_id": client_id, "client_secret": client_secret},
         headers={"Content-Type": "application/x-www-form-urlencoded"},
+        auth=lambda r: r,  # no bearer on the token request itself (overrides SESSION.auth)
         timeout=5
     )
     resp.raise_for_status()
-    return resp.json()["access_token"]
+    body = json_loads(resp.content)
+    # refresh a little before the real expiry (jittered) so polls never hit a 401
+    expires_in = body.get("expires_in", 3600)
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=expires_in - random.uniform(30, 90))
+    return body["access_token"], expires_at
+
+class TokenAuth(AuthBase):
+    # Bearer auth for SESSION: main loop refreshes proactively before expiry,
+    # the response hook refreshes once and resends if the API still answers 401.
+    def __init__(self, client_id: str, client_secret: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.header = None
+        self.expires_at = datetime.min.replace(tzinfo=timezone.utc)
+        self.load_cached()
+
+    def load_cached(self):
+        # Reuse the token from the last run if it is still good for more than a minute
+        try:
+            with open(TOKEN_CACHE) as f:
+                cached = json.load(f)
+            if cached["client_id"] != self.client_id:
+                return
+            token = cached["token"]
+            expires_at = datetime.fromisoformat(cached["exp"])
+            still_valid = expires_at - datetime.now(timezone.utc) > timedelta(seconds=60)
+        except (OSError, ValueError, KeyError, TypeError) as e:  # TypeError: naive "exp" or wrong JSON shape
+            log.info("No usable cached token (%s)", e)
+            return
+        if still_valid:
+            self.header = AUTH_TEMPLATE.format(token)
+            self.expires_at = expires_at
+
+    def save_cached(self, token: str):
+        # Atomic write (tmp file + os.replace), readable by the owner only
+        try:
+            os.makedirs(os.path.dirname(TOKEN_CACHE), exist_ok=True)
+            tmp = TOKEN_CACHE + ".tmp"
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"client_id": self.client_id, "token": token, "exp": self.expires_at.isoformat()}, f)
+            os.replace(tmp, TOKEN_CACHE)
+        except OSError as e:
+            log.warning("Could not cache token: %s", e)
+
+    def refresh(self):
+        token, self.expires_at = get_token(self.client_id, self.client_secret)
+        self.header = AUTH_TEMPLATE.format(token)  # built once per token, not per request
+        self.save_cached(token)
+
+    def refresh_if_due(self, now_utc: datetime):
+        if now_utc >= self.expires_at:
+            self.refresh()
+
+    def __call__(self, r):
+        r.headers["Authorization"] = self.header
+        r.register_hook("response", self.handle_401)
+        return r
+
+    def handle_401(self, r, **kwargs):
+        if r.status_code != 401:
+            return r
+        # token revoked early -> refresh and resend once (adapter.send runs no hooks, so no loop)
+        self.refresh()
+        r.content  # drain so the connection goes back to the pool
+        r.close()
+        prep = r.request.copy()
+        prep.headers["Authorization"] = self.header
+        retried = r.connection.send(prep, **kwargs)
+        retried.history.append(r)
+        retried.request = prep
+        return retried
 
 # --- state output (map API value -> LED/buzzer) ---
+# API value -> LED_PINS key, built once ("GREEN_POS" -> "green_pos", ...)
+COLOR_FOR = {api_value: api_value.lower() for api_value in VALUE_MAP}
+
 def apply_state(api_value: str):
-    if api_value == "BLUE":
-        led_ok("blue")
-    elif api_value == "GREEN_POS":
-        led_ok("green_pos")
-    elif api_value == "GREEN_NEG":
-        led_ok("green_neg")
-    elif api_value == "YELLOW_POS":
-        led_ok("yellow_pos")
-    elif api_value == "YELLOW_NEG":
-        led_ok("yellow_neg")
-    elif api_value == "RED_POS":
-        led_ok("red_pos")
-    elif api_value == "RED_NEG":
-        led_ok("red_neg")
+    try:
+        color = COLOR_FOR[api_value]
+    except KeyError:
+        print(f"Unknown state: {api_value}")
+        return
+    led_ok(color)
         
 '''
 def apply_state(api_value: str):
@@ -162,120 +282,163 @@ def apply_state(api_value: str):
 '''
 
 def failure_mode(reason: str):
-    logging.error("Failure mode: %s", reason)
+    log.error("Failure mode: %s", reason)
     led_error_blink()
     buzzer_error()
 
-def fetch_latest_rows(token: str, client_id: str, client_secret: str):
-    now_utc = datetime.now(timezone.utc)
+def countdown_until(deadline_utc: datetime):
+    # Sleep until deadline_utc, redrawing the countdown only when the whole second changes.
+    # Writes go straight to fd 1 (one write() per second, no print/flush machinery).
+    deadline = time.monotonic() + (deadline_utc - datetime.now(timezone.utc)).total_seconds()
+    shown = None
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        sec = int(remaining) + 1
+        if sec != shown:
+            if shown is None:
+                sys.stdout.flush()  # don't let buffered print() output land after our raw writes
+            os.write(1, b"\rSleeping: %02ds" % sec)
+            shown = sec
+        time.sleep(remaining - (sec - 1))  # wake exactly when the shown second ticks over
+    if shown is not None:
+        os.write(1, b"\r\x1b[K")  # back to column 0 and erase the countdown
+
+def next_expected_after(last_to: datetime) -> datetime:
+    # When the row after last_to should be available (small jitter so we don't hit the boundary exactly)
+    return last_to + ROW_INTERVAL + timedelta(seconds=random.uniform(0.5, 2.0))
+
+def stale_age(last_to: datetime | None, now_utc: datetime) -> timedelta | None:
+    # Age of the newest row seen so far if it is past STALE_AFTER, else None.
+    # Watches last_to on its own, so it works whether or not the current fetch succeeded.
+    if last_to is None:
+        return None
+    age = now_utc - last_to
+    return age if age > STALE_AFTER else None
+
+# --- conditional GET state (validators of the last data response) ---
+validators = {"url": None, "ETag": None, "Last-Modified": None}
+
+def get_rows(api_url: str):
+    # GET api_url, revalidating against the previous response for the same URL.
+    # Returns None on 304 Not Modified (rows unchanged since the last poll).
+    headers = {}
+    if api_url == validators["url"]:
+        if validators["ETag"]:
+            headers["If-None-Match"] = validators["ETag"]
+        if validators["Last-Modified"]:
+            headers["If-Modified-Since"] = validators["Last-Modified"]
+    r = SESSION.get(api_url, headers=headers, timeout=5)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    validators["url"] = api_url
+    validators["ETag"] = r.headers.get("ETag")
+    validators["Last-Modified"] = r.headers.get("Last-Modified")
+    return json_loads(r.content)
+
+def fetch_latest_rows(now_utc: datetime):
     to_utc  = now_utc.replace(second=0, microsecond=0)
-    from_utc = to_utc - timedelta(minutes=10)
-    fmt_api = "%Y-%m-%dT%H:%M:%SZ"
-    api_url = (
-        f"https://ds.netztransparenz.de/api/v1/data/TrafficLight/"
-        f"{from_utc.strftime(fmt_api)}/{to_utc.strftime(fmt_api)}"
-    )
+    from_utc = to_utc - FETCH_WINDOW  # only rows[-1] is used, so keep the response small
+    api_url = BASE_URL + fmt_api(from_utc) + "/" + fmt_api(to_utc)
 
-    try:
-        r = requests.get(api_url, headers={"Authorization": f"Bearer {token}"}, timeout=5)
-        r.raise_for_status()
-        return r.json(), token
-    except requests.HTTPError as e:
-        if e.response is not None and e.response.status_code == 401:
-            # refresh token once, then retry the same call
-            new_token = get_token(client_id, client_secret)
-            r2 = requests.get(api_url, headers={"Authorization": f"Bearer {new_token}"}, timeout=5)
-            r2.raise_for_status()
-            return r2.json(), new_token
-        raise
+    return get_rows(api_url)
 
 
 def main():
-    load_dotenv()
-    CLIENT_ID     = os.getenv("IPNT_CLIENT_ID")
-    CLIENT_SECRET = os.getenv("IPNT_CLIENT_SECRET")
-
-    token = get_token(CLIENT_ID, CLIENT_SECRET)
+    SESSION.auth = TokenAuth(CLIENT_ID, CLIENT_SECRET)  # picks up the cached token if still valid
+    SESSION.auth.refresh_if_due(datetime.now(timezone.utc))
 
     self_test_start()
     last_to = None
+    last_value = None  # last API value shown on the LEDs
+    latest_value = None  # numeric value of the last row, for the up/down chirp
     in_failure = False
-    first_after_start = True  # <- add this
+    next_expected = None
 
     # --- startup probe (unchanged logic, but using new fetch) ---
     try:
-        rows, token = fetch_latest_rows(token, CLIENT_ID, CLIENT_SECRET)
+        now_utc = datetime.now(timezone.utc)
+        rows = fetch_latest_rows(now_utc)
         if not rows:
             self_test_fail(); failure_mode("startup: empty response"); in_failure = True
         else:
             latest = rows[-1]
             latest_to = iso_utc(latest["To"])
-            age = datetime.now(timezone.utc) - latest_to
+            age = now_utc - latest_to
             if age > STALE_AFTER:
                 self_test_fail(); failure_mode(f"startup: stale data ({age})"); in_failure = True
             else:
                 self_test_success()
                 apply_state(latest["Value"])
+                last_value = latest["Value"]
+                latest_value = VALUE_MAP[last_value]
                 last_to = latest_to
+                next_expected = next_expected_after(last_to)
                 in_failure = False
-                f_loc = iso_utc(latest["From"]).astimezone(BERLIN).strftime("%Y-%m-%d %H:%M:%S %Z")
-                t_loc = latest_to.astimezone(BERLIN).strftime("%Y-%m-%d %H:%M:%S %Z")
-                logging.info("Initial state: %s → %s : %s", f_loc, t_loc, VALUE_MAP[latest["Value"]])
+                log.info("Initial state: %s → %s : %s",
+                         fmt_local(iso_utc(latest["From"])), fmt_local(latest_to), VALUE_MAP[latest["Value"]])
     except Exception as e:
         print("Caught exception:", e)
         self_test_fail(); failure_mode(f"startup error: {e}"); in_failure = True
 
     previous_value = -10
-    latest_value = 19  
+    next_poll = time.monotonic()
     while True:
+        # fixed cadence measured from iteration start; if we fell behind (slow request, countdown) restart from now
+        next_poll = max(next_poll, time.monotonic()) + POLL_INTERVAL_SEC
+        # one clock read per iteration, shared by token expiry, fetch window and stale checks
+        now_utc = datetime.now(timezone.utc)
         try:
-            rows, token = fetch_latest_rows(token, CLIENT_ID, CLIENT_SECRET)
-
-            if not rows:
+            SESSION.auth.refresh_if_due(now_utc)
+            rows = fetch_latest_rows(now_utc)
+
+            if rows is None:
+                # 304 Not Modified: same rows as last poll -> nothing to apply or log, only watch staleness
+                age = stale_age(last_to, now_utc)
+                if age is not None and not in_failure:
+                    failure_mode(f"stale data ({age})"); in_failure = True; last_value = None
+            elif not rows:
                 if not in_failure:
-                    failure_mode("empty response"); in_failure = True
+                    failure_mode("empty response"); in_failure = True; last_value = None
             else:
                 latest = rows[-1]
                 val = latest.get("Value")
                 if val not in VALUE_MAP:
                     if not in_failure:
-                        failure_mode(f"unknown value: {val}"); in_failure = True
+                        failure_mode(f"unknown value: {val}"); in_failure = True; last_value = None
                 else:
                     latest_to = iso_utc(latest["To"])
                         
                     if last_to is None or latest_to > last_to:
-                        numeric_val = VALUE_MAP.get(val)
-
-                        # Compare with previous value and chirp up/down
-                        if latest_value is not None and numeric_val is not None:
-                            if numeric_val > latest_value:
-                                buzzer_up()
-                            elif numeric_val < latest_value:
-                                buzzer_down()
-                            latest_value = numeric_val
-
+                        # new row: always advance the timestamp, that alone is cheap
                         last_to = latest_to
-                        apply_state(val)                        
-                        
-                        f_loc = iso_utc(latest["From"]).astimezone(BERLIN).strftime("%Y-%m-%d %H:%M:%S %Z")
-                        t_loc = latest_to.astimezone(BERLIN).strftime("%Y-%m-%d %H:%M:%S %Z")
-                        logging.info("%s → %s : %s", f_loc, t_loc, VALUE_MAP[val])
-
+                        next_expected = next_expected_after(last_to)
+
+                        # only touch buzzer / LEDs / log (and parse "From") when the value changed;
+                        # failure handling blanks the LEDs and resets last_value, so they get re-applied
+                        if val != last_value:
+                            numeric_val = VALUE_MAP[val]
+
+                            # Compare with previous value and chirp up/down
+                            if latest_value is not None:
+                                if numeric_val > latest_value:
+                                    buzzer_up()
+                                elif numeric_val < latest_value:
+                                    buzzer_down()
+                            latest_value = numeric_val
 
-                        if first_after_start:
-                            # skip the very first countdown
-                            first_after_start = False
-                        else:
-                            for sec in range(50, 0, -1):
-                                print(f"\rSleeping: {sec:02d}s", end="", flush=True)
-                                time.sleep(1)
-                            print("\r", end="")  # clear line when done
+                            apply_state(val)
+                            log.info("%s → %s : %s",
+                                     fmt_local(iso_utc(latest["From"])), fmt_local(latest_to), numeric_val)
+                            last_value = val
 
                     # stale check
-                    age = datetime.now(timezone.utc) - latest_to
-                    if age > STALE_AFTER:
+                    age = stale_age(last_to, now_utc)
+                    if age is not None:
                         if not in_failure:
-                            failure_mode(f"stale data ({age})"); in_failure = True
+                            failure_mode(f"stale data ({age})"); in_failure = True; last_value = None
                     else:
                         # success path clears failure state
                         in_failure = False
@@ -284,10 +447,11 @@ def main():
             print("caught exception here!")
             for pin in LED_PINS.values():
                 GPIO.output(pin, GPIO.LOW)            
-            now = datetime.now(timezone.utc)
-            if last_to is not None and (now - last_to > STALE_AFTER):
+            last_value = None  # LEDs are dark now -> re-apply on the next good row
+            age = stale_age(last_to, now_utc)
+            if age is not None:
                 if not in_failure:
-                    failure_mode(f"stale data during error handling ({now - last_to})")
+                    failure_mode(f"stale data during error handling ({age})")
                     in_failure = True
             else:
                 if not in_failure:
@@ -295,7 +459,12 @@ def main():
                     in_failure = True
                     
 
-        time.sleep(POLL_INTERVAL_SEC)
+        if next_expected is not None and now_utc < next_expected:
+            # nothing new can show up before the next slot -> don't poll until then
+            countdown_until(next_expected)
+        else:
+            # row is due (or late): fast poll until it arrives
+            time.sleep(max(0.0, next_poll - time.monotonic()))
 
 
 if __name__ == "__main__":